@@ -7,17 +7,27 @@ IOC Query Endpoints
 """
 
 import asyncio
+import hmac
+import ipaddress
 import logging
-from datetime import datetime, timedelta
+import re
+import time
 from typing import Optional
 
-from fastapi import APIRouter, Header, HTTPException, Depends
+import orjson
+
+from fastapi import APIRouter, Header, HTTPException, Depends, Query
+from fastapi.responses import Response
 from app.models.schemas import (
     IOCRequest, IOCResponse, IOCSummary, IOCHistoryEntry, IOCTimeline
 )
 from app.core.config import settings
 from app.core.scoring import score_ioc
-from app.core.db import init_db, save_query, get_ioc_summary, get_ioc_history, get_ioc_timeline
+from app.core.cache import cached
+from app.core.db import (
+    DatabaseBusyError, PAGE_SIZE, utc_timestamp, save_query,
+    get_ioc_summary, get_ioc_history, get_ioc_timeline
+)
 from app.core.providers import vt_lookup, securitytrails_lookup_domain, hunter_lookup_domain
 
 #===============================================
@@ -31,24 +41,11 @@ logger.setLevel(logging.DEBUG)
 #===============================================
 router = APIRouter(prefix="/api", tags=["threat-intelligence"])
 
-# Initialize database on app startup (not on import)
-_db_initialized = False
-
-def _ensure_db():
-    """Initialize database once on first request"""
-    global _db_initialized
-    if not _db_initialized:
-        try:
-            init_db()
-            _db_initialized = True
-            logger.info("Database initialized")
-        except Exception as e:
-            logger.error(f"DB init failed: {e}")
-            raise
-
 #===============================================
 # AUTHENTICATION
 #===============================================
+_API_KEY_BYTES = settings.API_KEY.encode()
+
 def verify_api_key(x_api_key: str = Header(...)) -> str:
     """
     Verify X-API-Key header matches configured API_KEY
@@ -62,27 +59,54 @@ def verify_api_key(x_api_key: str = Header(...)) -> str:
     Raises:
         HTTPException 401: If key doesn't match
     """
-    if x_api_key != settings.API_KEY:
+    if not hmac.compare_digest(x_api_key.encode(), _API_KEY_BYTES):
         logger.warning(f"Invalid API key attempt: {x_api_key[:4]}...")
         raise HTTPException(status_code=401, detail="Invalid API key")
     return x_api_key
 
+#===============================================
+# IOC VALIDATION PATTERNS
+#===============================================
+DOMAIN_RE = re.compile(r"^(?=.{1,253}$)(?:[a-z0-9_-]{1,63}\.)+(?:[a-z]{2,63}|xn--[a-z0-9-]{1,59})$", re.I)
+HASH_RE = re.compile(r"^[a-f0-9]{32}$|^[a-f0-9]{40}$|^[a-f0-9]{64}$", re.I)
+
+#===============================================
+# CACHE SETTINGS
+#===============================================
+READ_CACHE_TTL = 60        # /summary
+
+#===============================================
+# PROVIDERS (name, lookup, API key setting)
+#===============================================
+PROVIDERS = [
+    ("vt", vt_lookup, "VT_API_KEY"),
+    ("st", securitytrails_lookup_domain, "SECURITYTRAILS_API_KEY"),
+    ("whois", hunter_lookup_domain, "HUNTER_API_KEY"),
+]
+
 #===============================================
 # HELPER FUNCTIONS
 #===============================================
 
+async def _bounded(coro, timeout: float):
+    """Await coro with its own timeout, returning the exception instead of raising"""
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except Exception as e:
+        return e
+
 async def _enrich_ioc_parallel(
     ioc: str, 
     ioc_type: str, 
-    timeout: int = 10
+    timeout: int = 8
 ) -> tuple[Optional[dict], Optional[dict], Optional[dict]]:
     """
     Fetch enrichment data from multiple providers in parallel
     
     Flow:
-    1. Create async tasks for each provider (VT, SecurityTrails, Hunter)
-    2. Run all tasks concurrently with timeout
-    3. Handle individual provider failures gracefully
+    1. Create async tasks for each configured provider (VT, SecurityTrails, Hunter)
+    2. Run all tasks concurrently, each with its own timeout
+    3. Handle individual provider failures (or timeouts) gracefully
     4. Return tuple of results (or None if provider failed)
     
     Args:
@@ -103,50 +127,60 @@ async def _enrich_ioc_parallel(
         logger.info(f"Skipping providers for {ioc_type} type")
         return vt_data, st_data, whois_data
     
-    # Create async tasks
-    tasks = [
-        asyncio.create_task(vt_lookup(ioc)),
-        asyncio.create_task(securitytrails_lookup_domain(ioc)),
-        asyncio.create_task(hunter_lookup_domain(ioc)),
-    ]
+    # Only schedule providers that have an API key configured
+    enabled = [(name, lookup) for name, lookup, key_setting in PROVIDERS if getattr(settings, key_setting)]
+    if not enabled:
+        logger.info("No provider API keys configured")
+        return vt_data, st_data, whois_data
     
-    try:
-        # Run all tasks in parallel, catch individual exceptions
-        results = await asyncio.wait_for(
-            asyncio.gather(*tasks, return_exceptions=True),
-            timeout=timeout
-        )
-        
-        # Process results, skip if exception
-        vt_data = results[0] if isinstance(results[0], dict) else None
-        st_data = results[1] if isinstance(results[1], dict) else None
-        whois_data = results[2] if isinstance(results[2], dict) else None
-        
-        if isinstance(results[0], Exception):
-            logger.warning(f"VT lookup failed: {results[0]}")
-        if isinstance(results[1], Exception):
-            logger.warning(f"SecurityTrails lookup failed: {results[1]}")
-        if isinstance(results[2], Exception):
-            logger.warning(f"Hunter lookup failed: {results[2]}")
-            
-    except asyncio.TimeoutError:
-        logger.error(f"Provider timeout after {timeout}s for {ioc}")
-        return None, None, None
+    # Run providers in parallel; a slow one only loses its own result
+    results = await asyncio.gather(*(_bounded(lookup(ioc), timeout) for _, lookup in enabled))
+    
+    # Process results, skip if exception
+    out = {}
+    for (name, _), result in zip(enabled, results):
+        if isinstance(result, Exception):
+            logger.warning(f"{name} lookup failed: {result!r}")
+        out[name] = result if isinstance(result, dict) else None
+    vt_data, st_data, whois_data = out.get("vt"), out.get("st"), out.get("whois")
     
     return vt_data, st_data, whois_data
 
-def _validate_ioc(ioc: str) -> bool:
+def _check_page(rows: Optional[list[dict]], cursor: Optional[int]):
+    """
+    Raise for a page the client can't use
+
+    400 if the cursor is not an entry of this IOC, 404 if the IOC has no
+    entries at all. Past the last page [] is a valid result.
+    """
+    if rows is None:
+        raise HTTPException(status_code=400, detail="Unknown cursor for this IOC")
+    if not rows and cursor is None:
+        raise HTTPException(status_code=404, detail="IOC not found")
+
+def _validate_ioc(ioc: str, ioc_type: str) -> bool:
     """
-    Simple IOC validation (length, format)
+    IOC validation (length, then format for the given type)
     
     Args:
         ioc: The indicator to validate
+        ioc_type: Type of indicator (ip, domain, hash)
         
     Returns:
         True if valid, False otherwise
     """
     if not ioc or len(ioc) < 3 or len(ioc) > 255:
         return False
+    if ioc_type == "ip":
+        try:
+            ipaddress.ip_address(ioc)
+        except ValueError:
+            return False
+        return True
+    if ioc_type == "domain":
+        return DOMAIN_RE.match(ioc) is not None
+    if ioc_type == "hash":
+        return HASH_RE.match(ioc) is not None
     return True
 
 #===============================================
@@ -157,7 +191,7 @@ def _validate_ioc(ioc: str) -> bool:
 async def query_ioc(
     request: IOCRequest,
     api_key: str = Depends(verify_api_key)
-) -> IOCResponse:
+) -> Response:
     """
     Query & Enrich an Indicator of Compromise
 
@@ -179,6 +213,7 @@ async def query_ioc(
     - 200: Success
     - 401: Invalid API key
     - 422: Validation error
+    - 503: Database busy
     - 504: Provider timeout
 
     Args:
@@ -189,27 +224,25 @@ async def query_ioc(
         IOCResponse with enriched data and score
     """
 
-    _ensure_db()
-
     ioc = request.ioc.strip()
     ioc_type = request.ioc_type or "domain"
 
     # Validate IOC
-    if not _validate_ioc(ioc):
+    if not _validate_ioc(ioc, ioc_type):
         logger.warning(f"Invalid IOC format: {ioc}")
         raise HTTPException(
             status_code=422,
-            detail="Invalid IOC format (3-255 chars)"
+            detail=f"Invalid IOC format for type '{ioc_type}'"
         )
 
     logger.info(f"Querying {ioc_type}: {ioc}")
 
     try:
         # Step 1: Fetch enrichment data in parallel
-        start_time = datetime.utcnow()
+        start = time.monotonic_ns()
         vt_data, st_data, whois_data = await _enrich_ioc_parallel(ioc, ioc_type)
-        elapsed_ms = (datetime.utcnow() - start_time).total_seconds() * 1000
-        logger.info(f"Enrichment completed in {elapsed_ms:.0f}ms")
+        elapsed_ms = (time.monotonic_ns() - start) // 1_000_000
+        logger.info(f"Enrichment completed in {elapsed_ms}ms")
 
         # Step 2: Calculate threat score
         score, risk_level, sources = score_ioc(
@@ -218,36 +251,43 @@ async def query_ioc(
             whois_data=whois_data
         )
         logger.info(f"Score: {score}/100 | Risk: {risk_level} | Sources: {sources}")
+        created_at = utc_timestamp()
+
+        # Serialize provider blobs once, reused for the DB row and the response
+        vt_json = orjson.dumps(vt_data) if vt_data else None
+        st_json = orjson.dumps(st_data) if st_data else None
+        whois_json = orjson.dumps(whois_data) if whois_data else None
 
-        # Step 3: Save to database
-        save_query(
+        # Step 3: Save to database (batched by the background writer)
+        await save_query(
             ioc, ioc_type, score, risk_level, sources,
-            vt_data, st_data, whois_data
-        )
-        logger.info(f"Saved to database")
-
-        # Step 4: Return response
-        response = IOCResponse(
-            ioc=ioc,
-            ioc_type=ioc_type,
-            score=score,
-            risk_level=risk_level,
-            sources=sources,
-            vt=vt_data,
-            st=st_data,
-            whois=whois_data,
-            created_at=datetime.utcnow().isoformat()
+            vt_json, st_json, whois_json, created_at
         )
+        logger.info(f"Queued for database")
+
+        # Step 4: Return response (IOCResponse shape, blobs embedded as raw JSON)
+        body = orjson.dumps({
+            "ioc": ioc,
+            "ioc_type": ioc_type,
+            "score": score,
+            "risk_level": risk_level,
+            "sources": sources,
+            "vt": orjson.Fragment(vt_json) if vt_json else None,
+            "st": orjson.Fragment(st_json) if st_json else None,
+            "whois": orjson.Fragment(whois_json) if whois_json else None,
+            "created_at": created_at,
+        })
         logger.debug(f"Response ready for {ioc}")
-        return response
+        return Response(content=body, media_type="application/json")
 
-    except HTTPException as e:
-        raise e
+    except (HTTPException, DatabaseBusyError):
+        raise
     except Exception as e:
         logger.error(f"Unexpected error querying {ioc}: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @router.get("/summary/{ioc}", response_model=IOCSummary)
+@cached(ttl=READ_CACHE_TTL, key=lambda ioc: f"sum:{ioc}")
 async def get_summary(
     ioc: str,
     api_key: str = Depends(verify_api_key)
@@ -272,19 +312,17 @@ async def get_summary(
     Raises:
         404: IOC not found in database
     """
-    _ensure_db()
-
     ioc = ioc.strip()
     logger.info(f"Getting summary for {ioc}")
 
     try:
-        data = get_ioc_summary(ioc)
+        data = await get_ioc_summary(ioc)
         if not data:
             logger.warning(f"Summary not found for {ioc}")
             raise HTTPException(status_code=404, detail="IOC not found")
 
         logger.debug(f"Summary found: {data}")
-        return IOCSummary(**data)
+        return IOCSummary.model_construct(**data)
         
     except Exception as e:
         logger.error(f"Error getting summary for {ioc}: {e}")
@@ -293,42 +331,46 @@ async def get_summary(
 @router.get("/history/{ioc}", response_model=list[IOCHistoryEntry])
 async def get_history(
     ioc: str, 
+    before_id: Optional[int] = Query(default=None, ge=1),
+    limit: int = Query(default=PAGE_SIZE, ge=1, le=1000),
     api_key: str = Depends(verify_api_key)
-) -> list[IOCHistoryEntry]:
+) -> Response:
     """
     Get Query History for IOC (All Historical Scores)
 
-    Returns all times this IOC was queried with scoring at each time.
+    Returns the times this IOC was queried with scoring at each time,
+    newest first, at most `limit` (default 200) per page. Page through
+    older entries by passing the smallest `id` seen as `before_id`; past
+    the last page the result is `[]`.
     Useful for tracking how threat assessment changes over time.
 
     **Example:**
     ```bash
-    curl -H "X-API-Key: key" http://127.0.0.1:8000/api/history/1.1.1.1 | jq
+    curl -H "X-API-Key: key" "http://127.0.0.1:8000/api/history/1.1.1.1?limit=50" | jq
     ```
 
     Args:
         ioc: The indicator to get history for
+        before_id: Only return entries older than this entry id
+        limit: Max entries to return (1-1000)
         api_key: X-API-Key header
 
     Returns:
-        List of IOCHistoryEntry with score, risk_level, created_at
+        List of IOCHistoryEntry with id, score, risk_level, created_at
 
     Raises:
+        400: before_id is not an entry of this IOC
         404: IOC not found in database
     """
-    _ensure_db()
-
     ioc = ioc.strip()
     logger.info(f"Getting history for {ioc}")
 
     try:
-        history = get_ioc_history(ioc)
-        if not history:
-            logger.warning(f"History not found for {ioc}")
-            raise HTTPException(status_code=404, detail="IOC not found")
+        rows = await get_ioc_history(ioc, before_id, limit)
+        _check_page(rows, before_id)
 
-        logger.info(f"Found {len(history)} history entries")
-        return [IOCHistoryEntry(**h) for h in history]
+        logger.info(f"Found {len(rows)} history entries")
+        return Response(orjson.dumps(rows), media_type="application/json")
 
     except Exception as e:
         logger.error(f"Error getting history for {ioc}: {e}")
@@ -337,8 +379,10 @@ async def get_history(
 @router.get("/timeline/{ioc}", response_model=list[IOCTimeline])
 async def get_timeline(
     ioc: str,
+    after_id: Optional[int] = Query(default=None, ge=1),
+    limit: int = Query(default=PAGE_SIZE, ge=1, le=1000),
     api_key: str = Depends(verify_api_key)
-) -> list[IOCTimeline]:
+) -> Response:
     """
     Get Activity Timeline (Temporal Analysis)
 
@@ -349,6 +393,9 @@ async def get_timeline(
     - Activity phases (active, dormant, resurrected)
 
     Useful for determining if infrastructure is currently in use.
+    Points are returned oldest first, at most `limit` (default 200) per
+    page. Page through newer points by passing the last `id` seen as
+    `after_id`; past the last page the result is `[]`.
 
     **Example:**
     ```bash
@@ -357,27 +404,26 @@ async def get_timeline(
 
     Args:
         ioc: The indicator to timeline
+        after_id: Only return points after this entry
+        limit: Max points to return (1-1000)
         api_key: X-API-Key header
 
     Returns:
-        List of IOCTimeline with timestamp, phase, burned flag
+        List of IOCTimeline with id, timestamp, phase, burned flag
 
     Raises:
+        400: after_id is not an entry of this IOC
         404: IOC not found in database
     """
-    _ensure_db()
-
     ioc = ioc.strip()
     logger.info(f"Getting timeline for {ioc}")
 
     try:
-        timeline = get_ioc_timeline(ioc)
-        if not timeline:
-            logger.warning(f"Timeline not found for {ioc}")
-            raise HTTPException(status_code=404, detail="IOC not found")
+        rows = await get_ioc_timeline(ioc, after_id, limit)
+        _check_page(rows, after_id)
 
-        logger.info(f"Found {len(timeline)} timeline points")
-        return [IOCTimeline(**t) for t in timeline]
+        logger.info(f"Found {len(rows)} timeline points")
+        return Response(orjson.dumps(rows), media_type="application/json")
 
     except Exception as e:
         logger.error(f"Error getting timeline for {ioc}: {e}")
@@ -0,0 +1,146 @@
+"""
+Response cache
+- Redis (redis.asyncio) when REDIS_URL is configured
+- In-process LRU with TTL as fallback
+"""
+
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Callable, Optional
+
+import orjson
+from pydantic_core import to_json
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+_LOCAL_MAXSIZE = 1024
+# Version keys must outlive any cached value so a reset can't resurrect stale data
+_VERSION_TTL = 86400
+
+_redis = None
+_local: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+_versions: "OrderedDict[str, int]" = OrderedDict()
+_version_counter = itertools.count(1)
+
+async def init_cache():
+    """Connect to Redis if configured, otherwise stay on the local LRU"""
+    global _redis
+    if not settings.REDIS_URL:
+        logger.info("REDIS_URL not set, using in-process cache")
+        return
+    try:
+        import redis.asyncio as redis
+        client = redis.from_url(settings.REDIS_URL, decode_responses=True)
+        await client.ping()
+        _redis = client
+        logger.info("Redis cache connected")
+    except Exception as e:
+        logger.warning(f"Redis unavailable, using in-process cache: {e}")
+
+async def close_cache():
+    """Close the Redis connection (called on app shutdown)"""
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+    _local.clear()
+    _versions.clear()
+
+async def cache_get(key: str) -> Optional[str]:
+    """Return the cached value for key, or None on miss"""
+    if _redis is not None:
+        try:
+            return await _redis.get(key)
+        except Exception as e:
+            logger.warning(f"Redis get failed for {key}: {e}")
+            return None
+
+    entry = _local.get(key)
+    if entry is None:
+        return None
+    expires_at, value = entry
+    if expires_at < time.monotonic():
+        _local.pop(key, None)
+        return None
+    _local.move_to_end(key)
+    return value
+
+async def cache_set(key: str, value: str, ttl: int):
+    """Store value under key for ttl seconds"""
+    if _redis is not None:
+        try:
+            await _redis.set(key, value, ex=ttl)
+        except Exception as e:
+            logger.warning(f"Redis set failed for {key}: {e}")
+        return
+
+    _local[key] = (time.monotonic() + ttl, value)
+    _local.move_to_end(key)
+    while len(_local) > _LOCAL_MAXSIZE:
+        _local.popitem(last=False)
+
+async def cache_version(key: str) -> str:
+    """Current version of key; cached values are stored under key@version"""
+    if _redis is not None:
+        try:
+            return await _redis.get(f"ver:{key}") or "0"
+        except Exception as e:
+            logger.warning(f"Redis get failed for ver:{key}: {e}")
+            return "0"
+    return str(_versions.get(key, 0))
+
+async def cache_invalidate(*keys: str):
+    """
+    Bump the version of keys so existing entries are never read again
+
+    Entries written under an old version by a reader that raced the
+    write simply expire with their TTL.
+    """
+    if _redis is not None:
+        try:
+            async with _redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.incr(f"ver:{key}")
+                    pipe.expire(f"ver:{key}", _VERSION_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis version bump failed for {keys}: {e}")
+        return
+
+    for key in keys:
+        _local.pop(f"{key}@{_versions.get(key, 0)}", None)
+        _versions[key] = next(_version_counter)
+        _versions.move_to_end(key)
+    while len(_versions) > _LOCAL_MAXSIZE:
+        evicted, _ = _versions.popitem(last=False)
+        # The evicted key reads as version 0 again, drop anything stored there
+        _local.pop(f"{evicted}@0", None)
+
+def cached(ttl: int, key: Callable[[str], str]):
+    """
+    Cache an endpoint's result as JSON, keyed by its ioc argument
+
+    On a hit the decoded JSON is returned and FastAPI validates it
+    against the route's response_model. The version is read before the
+    DB call, so a result computed from pre-write data lands under the
+    old version and is never served after cache_invalidate.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(ioc: str, *args, **kwargs):
+            base_key = key(ioc.strip())
+            cache_key = f"{base_key}@{await cache_version(base_key)}"
+            hit = await cache_get(cache_key)
+            if hit is not None:
+                return orjson.loads(hit)
+
+            result = await func(ioc, *args, **kwargs)
+            await cache_set(cache_key, to_json(result).decode(), ttl)
+            return result
+        return wrapper
+    return decorator
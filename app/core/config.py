@@ -11,6 +11,8 @@ class Settings(BaseSettings):
     SECURITYTRAILS_API_KEY: Optional[str] = None
     HUNTER_API_KEY: Optional[str] = None
 
+    REDIS_URL: Optional[str] = None
+
     model_config = ConfigDict(env_file=".env", extra="ignore")
 
 settings = Settings()
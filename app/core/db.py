@@ -1,108 +1,481 @@
+import asyncio
+import logging
 import sqlite3
-import json
-from datetime import datetime
+import orjson
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from typing import Optional
+
+from app.core.cache import cache_invalidate
+
+logger = logging.getLogger(__name__)
 
 DB_PATH = Path("data/database.db")
+POOL_SIZE = 4
+POOL_TIMEOUT = 5           # seconds to wait for a free connection
+POOL_CLOSE_TIMEOUT = 2     # seconds close_db waits for checked-out connections
+WRITE_BATCH_SIZE = 100
+WRITE_BATCH_WAIT = 0.02    # seconds to let a burst of inserts accumulate
+WRITE_QUEUE_SIZE = 1000    # queued rows before save_query answers 503
+WRITE_RETRIES = 3          # extra attempts for a batch that hit a locked database
+WRITE_RETRY_BACKOFF = 0.05 # seconds before the first retry, doubled each time
+WRITER_STOP_TIMEOUT = 10   # seconds stop_writer waits for queued rows to flush
+PAGE_SIZE = 200            # default /history and /timeline page
+PROVIDER_DB_CACHE_TTL = 3600    # provider_cache rows older than this are stale
+
+_pool = None
+_pool_lock = threading.Lock()
+_closed = False
+
+class DatabaseBusyError(Exception):
+    """No pooled connection became free within POOL_TIMEOUT, or the pool is shut down"""
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # Per-connection settings (journal_mode is set once in init_db)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    # Keep PRAGMA optimize cheap on large tables (sampled ANALYZE)
+    conn.execute("PRAGMA analysis_limit=400")
+    return conn
+
+def _close_conn(conn):
+    """Refresh planner statistics and close conn; errors are logged, not raised"""
+    try:
+        conn.execute("PRAGMA optimize")
+    except sqlite3.Error as e:
+        logger.warning(f"PRAGMA optimize failed on shutdown: {e}")
+    try:
+        conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Error closing DB connection: {e}")
 
-def dict_factory(cursor, row):
-    """Convierte filas SQLite a diccionarios y parsea JSON fields"""
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        value = row[idx]
-        # Parse JSON fields
-        if col[0] in ['sources', 'vt', 'st', 'whois'] and isinstance(value, str):
+def _get_pool():
+    global _pool
+    if _closed:
+        raise DatabaseBusyError("Database is shut down")
+    if _pool is None:
+        with _pool_lock:
+            if _closed:
+                raise DatabaseBusyError("Database is shut down")
+            if _pool is None:
+                pool = queue.Queue(maxsize=POOL_SIZE)
+                for _ in range(POOL_SIZE):
+                    pool.put(_connect())
+                _pool = pool
+    return _pool
+
+@contextmanager
+def get_conn():
+    """Borrow a pooled connection, returning it to the pool afterwards"""
+    pool = _get_pool()
+    try:
+        conn = pool.get(timeout=POOL_TIMEOUT)
+    except queue.Empty:
+        raise DatabaseBusyError(f"No database connection free after {POOL_TIMEOUT}s") from None
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if _closed:
+            # Returned after close_db gave up waiting for it
+            _close_conn(conn)
+        else:
+            pool.put(conn)
+
+def close_db():
+    """
+    Close the pool and refuse new checkouts (called on app shutdown)
+
+    Idle connections are closed at once; checked-out ones get up to
+    POOL_CLOSE_TIMEOUT to come back, after that get_conn closes them
+    when they are returned.
+    """
+    global _pool, _closed
+    with _pool_lock:
+        _closed = True
+        if _pool is None:
+            return
+        deadline = time.monotonic() + POOL_CLOSE_TIMEOUT
+        for closed in range(POOL_SIZE):
             try:
-                value = json.loads(value)
-            except:
-                value = None
-        d[col[0]] = value
-    return d
+                conn = _pool.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                logger.warning(f"{POOL_SIZE - closed} DB connections still in use at shutdown")
+                break
+            _close_conn(conn)
+        _pool = None
+
+def _loads(value):
+    """Decode a JSON column (TEXT or BLOB), None if empty or malformed"""
+    if value is None:
+        return None
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        return None
+
+def _row_to_summary(row):
+    ioc, ioc_type, score, risk_level, sources, created_at = row
+    return {
+        "ioc": ioc,
+        "ioc_type": ioc_type,
+        "score": score,
+        "risk_level": risk_level,
+        "sources": _loads(sources) or [],
+        "created_at": created_at,
+    }
+
+def _row_to_history(row):
+    id_, ioc, ioc_type, score, risk_level, sources, created_at = row
+    return {
+        "id": id_,
+        "ioc": ioc,
+        "ioc_type": ioc_type,
+        "score": score,
+        "risk_level": risk_level,
+        "sources": _loads(sources) or [],
+        "created_at": created_at,
+    }
+
+def _row_to_timeline(row):
+    id_, timestamp, score, risk_level, phase, burned = row
+    return {
+        "id": id_,
+        "timestamp": timestamp,
+        "score": score,
+        "risk_level": risk_level,
+        "phase": phase,
+        "burned": bool(burned),
+    }
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS ioc_queries (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        ioc TEXT NOT NULL,
-        ioc_type TEXT NOT NULL,
-        score INTEGER NOT NULL CHECK(score >= 0 AND score <= 100),
-        risk_level TEXT NOT NULL CHECK(risk_level IN ('low', 'medium', 'high', 'critical')),
-        sources TEXT,
-        vt TEXT,
-        st TEXT,
-        whois TEXT,
-        first_seen_global TEXT,
-        last_updated TEXT,
-        burned_infra INTEGER DEFAULT 0,
-        activity_phase TEXT DEFAULT 'unknown',
-        created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    conn.commit()
-    conn.close()
+    global _closed
+    _closed = False
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ioc_queries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ioc TEXT NOT NULL,
+            ioc_type TEXT NOT NULL,
+            score INTEGER NOT NULL CHECK(score >= 0 AND score <= 100),
+            risk_level TEXT NOT NULL CHECK(risk_level IN ('low', 'medium', 'high', 'critical')),
+            sources TEXT,
+            vt TEXT,
+            st TEXT,
+            whois TEXT,
+            first_seen_global TEXT,
+            last_updated TEXT,
+            burned_infra INTEGER DEFAULT 0,
+            activity_phase TEXT DEFAULT 'unknown',
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS provider_cache (
+            ioc TEXT NOT NULL,
+            provider TEXT NOT NULL,
+            fetched_at TEXT NOT NULL,
+            data_json TEXT NOT NULL,
+            PRIMARY KEY (ioc, provider)
+        )
+        """)
+        # Keyset paging for /history
+        cursor.execute("CREATE INDEX IF NOT EXISTS ioc_id_idx ON ioc_queries(ioc, id)")
+        # Covering index for /timeline; /summary also seeks it (scanned backwards)
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_ioc_timeline
+        ON ioc_queries(ioc, created_at, score, risk_level, activity_phase, burned_infra)
+        """)
+        # Expired provider results are never read again
+        cutoff = utc_timestamp(datetime.now(timezone.utc) - timedelta(seconds=PROVIDER_DB_CACHE_TTL))
+        cursor.execute("DELETE FROM provider_cache WHERE fetched_at < ?", (cutoff,))
+        conn.commit()
+        # Bounded statistics refresh instead of a full ANALYZE at every boot
+        cursor.execute("PRAGMA optimize=0x10002")
     print("DB initialized")
 
-def save_query(ioc, ioc_type, score, risk_level, sources, vt_data, st_data, whois_data):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    created_at = datetime.utcnow().isoformat()
-    
-    cursor.execute("""
-    INSERT INTO ioc_queries 
-    (ioc, ioc_type, score, risk_level, sources, vt, st, whois, created_at)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+def utc_timestamp(dt=None):
+    """ISO-8601 UTC timestamp with millisecond precision"""
+    return (dt or datetime.now(timezone.utc)).isoformat(timespec="milliseconds")
+
+def _query_row(ioc, ioc_type, score, risk_level, sources, vt_json, st_json, whois_json, created_at=None):
+    # vt/st/whois arrive pre-encoded (orjson bytes) and are stored as BLOBs
+    return (
         ioc,
         ioc_type,
         score,
         risk_level,
-        json.dumps(sources) if sources else None,
-        json.dumps(vt_data) if vt_data else None,
-        json.dumps(st_data) if st_data else None,
-        json.dumps(whois_data) if whois_data else None,
-        created_at
-    ))
-    
-    conn.commit()
-    conn.close()
-
-def get_ioc_summary(ioc):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM ioc_queries WHERE ioc = ? ORDER BY created_at DESC LIMIT 1", (ioc,))
-    row = cursor.fetchone()
-    conn.close()
-    return row
-
-def get_ioc_history(ioc):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM ioc_queries WHERE ioc = ? ORDER BY created_at DESC", (ioc,))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
-
-def get_ioc_timeline(ioc):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT 
-        created_at as timestamp, 
-        score, 
-        risk_level, 
-        activity_phase as phase, 
-        burned_infra as burned
-    FROM ioc_queries 
-    WHERE ioc = ? 
-    ORDER BY created_at ASC
-    """, (ioc,))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+        orjson.dumps(sources).decode() if sources else None,
+        vt_json,
+        st_json,
+        whois_json,
+        created_at or utc_timestamp()
+    )
+
+def _insert_queries(rows):
+    with get_conn() as conn:
+        conn.executemany("""
+        INSERT INTO ioc_queries 
+        (ioc, ioc_type, score, risk_level, sources, vt, st, whois, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+
+def _is_busy(e):
+    """True for errors worth retrying: no free connection or a locked database"""
+    if isinstance(e, DatabaseBusyError):
+        return True
+    return isinstance(e, sqlite3.OperationalError) and "locked" in str(e)
+
+def _insert_with_retry(rows):
+    """_insert_queries, retried with backoff while the database is busy"""
+    delay = WRITE_RETRY_BACKOFF
+    for attempt in range(WRITE_RETRIES):
+        try:
+            return _insert_queries(rows)
+        except (sqlite3.OperationalError, DatabaseBusyError) as e:
+            if not _is_busy(e):
+                raise
+            logger.warning(f"Database busy writing {len(rows)} queries, retrying in {delay}s: {e}")
+        time.sleep(delay)
+        delay *= 2
+    _insert_queries(rows)
+
+def _sync_save_queries(rows):
+    """
+    Insert a batch of ioc_queries rows in a single transaction
+
+    A busy or locked database is retried as a whole batch. Only a constraint
+    violation falls back to row-by-row inserts, so one bad row doesn't drop
+    the rest. Returns [(row, error)] for rows that could not be written.
+    """
+    try:
+        _insert_with_retry(rows)
+        return []
+    except sqlite3.IntegrityError as e:
+        logger.warning(f"Batch insert of {len(rows)} queries failed, retrying row by row: {e}")
+    except (sqlite3.Error, DatabaseBusyError) as e:
+        logger.error(f"Failed to write {len(rows)} queries: {e}")
+        return [(row, e) for row in rows]
+
+    failed = []
+    for row in rows:
+        try:
+            _insert_with_retry([row])
+        except (sqlite3.Error, DatabaseBusyError) as e:
+            logger.error(f"Failed to write query for {row[0]}: {e}")
+            failed.append((row, e))
+    return failed
+
+def _sync_get_ioc_summary(ioc):
+    with get_conn() as conn:
+        row = conn.execute("""
+        SELECT ioc, ioc_type, score, risk_level, sources, created_at
+        FROM ioc_queries
+        WHERE ioc = ?
+        ORDER BY created_at DESC
+        LIMIT 1
+        """, (ioc,)).fetchone()
+    return _row_to_summary(row) if row else None
+
+def _sync_get_ioc_history(ioc, before_id=None, limit=PAGE_SIZE):
+    """
+    One page of history, newest first
+
+    Keyset pagination: pass the smallest id seen as before_id for the next page.
+    Returns None if before_id is not an entry of this ioc.
+    The page is fetched in full so the connection goes straight back to the pool.
+    """
+    with get_conn() as conn:
+        if before_id is not None and conn.execute(
+            "SELECT 1 FROM ioc_queries WHERE id = ? AND ioc = ?", (before_id, ioc)
+        ).fetchone() is None:
+            return None
+        rows = conn.execute("""
+        SELECT id, ioc, ioc_type, score, risk_level, sources, created_at
+        FROM ioc_queries
+        WHERE ioc = ? AND id < ?
+        ORDER BY id DESC
+        LIMIT ?
+        """, (ioc, before_id if before_id is not None else 2**63 - 1, limit)).fetchall()
+    return [_row_to_history(row) for row in rows]
+
+def _sync_get_ioc_timeline(ioc, after_id=None, limit=PAGE_SIZE):
+    """
+    One page of timeline points, oldest first
+
+    Keyset pagination on (created_at, id): pass the last id seen as after_id.
+    Returns None if after_id is not an entry of this ioc.
+    """
+    with get_conn() as conn:
+        if after_id is None:
+            rows = conn.execute("""
+            SELECT 
+                id,
+                created_at as timestamp, 
+                score, 
+                risk_level, 
+                activity_phase as phase, 
+                burned_infra as burned
+            FROM ioc_queries 
+            WHERE ioc = ? 
+            ORDER BY created_at ASC, id ASC
+            LIMIT ?
+            """, (ioc, limit)).fetchall()
+        else:
+            cursor_row = conn.execute(
+                "SELECT created_at FROM ioc_queries WHERE id = ? AND ioc = ?", (after_id, ioc)
+            ).fetchone()
+            if cursor_row is None:
+                return None
+            rows = conn.execute("""
+            SELECT 
+                id,
+                created_at as timestamp, 
+                score, 
+                risk_level, 
+                activity_phase as phase, 
+                burned_infra as burned
+            FROM ioc_queries 
+            WHERE ioc = ?
+              AND (created_at, id) > (?, ?)
+            ORDER BY created_at ASC, id ASC
+            LIMIT ?
+            """, (ioc, cursor_row[0], after_id, limit)).fetchall()
+    return [_row_to_timeline(row) for row in rows]
+
+def _sync_get_provider_cache(ioc, provider, max_age):
+    """Return a stored provider result younger than max_age seconds, or None"""
+    cutoff = utc_timestamp(datetime.now(timezone.utc) - timedelta(seconds=max_age))
+    with get_conn() as conn:
+        row = conn.execute(
+            "SELECT data_json FROM provider_cache WHERE ioc = ? AND provider = ? AND fetched_at >= ?",
+            (ioc, provider, cutoff)
+        ).fetchone()
+    return orjson.loads(row[0]) if row else None
+
+def _sync_save_provider_cache(ioc, provider, data):
+    with get_conn() as conn:
+        conn.execute("""
+        INSERT OR REPLACE INTO provider_cache (ioc, provider, fetched_at, data_json)
+        VALUES (?, ?, ?, ?)
+        """, (ioc, provider, utc_timestamp(), orjson.dumps(data).decode()))
+        conn.commit()
+
+#===============================================
+# ASYNC API (SQLite work runs off the event loop)
+#===============================================
+
+async def save_query(ioc, ioc_type, score, risk_level, sources, vt_json, st_json, whois_json, created_at=None):
+    """
+    Queue a row for the background writer (writes directly if it isn't running)
+
+    vt_json/st_json/whois_json are the provider blobs already encoded with
+    orjson.dumps (or None). Raises DatabaseBusyError when the writer is
+    WRITE_QUEUE_SIZE rows behind.
+    """
+    row = _query_row(ioc, ioc_type, score, risk_level, sources, vt_json, st_json, whois_json, created_at)
+    if _writer_task is None:
+        failed = await _flush([row])
+        if failed:
+            raise failed[0][1]
+        return
+    try:
+        _insert_queue.put_nowait(row)
+    except asyncio.QueueFull:
+        raise DatabaseBusyError(f"Write queue full ({WRITE_QUEUE_SIZE} rows pending)") from None
+
+async def get_ioc_summary(ioc):
+    return await asyncio.to_thread(_sync_get_ioc_summary, ioc)
+
+async def get_ioc_history(ioc, before_id=None, limit=PAGE_SIZE):
+    return await asyncio.to_thread(_sync_get_ioc_history, ioc, before_id, limit)
+
+async def get_ioc_timeline(ioc, after_id=None, limit=PAGE_SIZE):
+    return await asyncio.to_thread(_sync_get_ioc_timeline, ioc, after_id, limit)
+
+async def get_provider_cache(ioc, provider, max_age):
+    return await asyncio.to_thread(_sync_get_provider_cache, ioc, provider, max_age)
+
+async def save_provider_cache(ioc, provider, data):
+    await asyncio.to_thread(_sync_save_provider_cache, ioc, provider, data)
+
+#===============================================
+# BACKGROUND WRITER (batched inserts)
+#===============================================
+
+_insert_queue: Optional[asyncio.Queue] = None
+_writer_task: Optional[asyncio.Task] = None
+
+async def _flush(rows):
+    """Write rows and invalidate cached summaries; returns [(row, error)] for failed rows"""
+    failed = await asyncio.to_thread(_sync_save_queries, rows)
+    written = {row[0] for row in rows} - {row[0] for row, _ in failed}
+    if written:
+        await cache_invalidate(*(f"sum:{ioc}" for ioc in written))
+    return failed
+
+async def _writer_loop():
+    """Drain the insert queue, writing up to WRITE_BATCH_SIZE rows per transaction"""
+    stopping = False
+    while not stopping:
+        row = await _insert_queue.get()
+        if row is None:
+            break
+        rows = [row]
+        if _insert_queue.qsize() < WRITE_BATCH_SIZE:
+            await asyncio.sleep(WRITE_BATCH_WAIT)
+        while len(rows) < WRITE_BATCH_SIZE and not _insert_queue.empty():
+            row = _insert_queue.get_nowait()
+            if row is None:
+                stopping = True
+                break
+            rows.append(row)
+        try:
+            await _flush(rows)
+        except Exception as e:
+            # Keep the writer alive; failures inside the batch are already logged
+            logger.exception(f"Writer failed on a batch of {len(rows)} queries: {e}")
+
+def start_writer():
+    """Start the background writer (called on app startup)"""
+    global _insert_queue, _writer_task
+    if _writer_task is None:
+        _insert_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+        _writer_task = asyncio.create_task(_writer_loop())
+
+async def _drain_writer():
+    await _insert_queue.put(None)
+    await _writer_task
+
+async def stop_writer():
+    """
+    Flush pending rows and stop the background writer (called on app shutdown)
+
+    Gives up after WRITER_STOP_TIMEOUT, dropping whatever is still queued.
+    """
+    global _insert_queue, _writer_task
+    if _writer_task is None:
+        return
+    try:
+        await asyncio.wait_for(_drain_writer(), WRITER_STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        _writer_task.cancel()
+        logger.error(
+            f"Writer did not finish within {WRITER_STOP_TIMEOUT}s, "
+            f"dropping {_insert_queue.qsize()} queued queries"
+        )
+    _insert_queue = None
+    _writer_task = None
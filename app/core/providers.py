@@ -1,61 +1,132 @@
+import asyncio
+import time
 import httpx
+import orjson
+from functools import wraps
+from typing import Optional
 from app.core.config import settings
+from app.core.db import PROVIDER_DB_CACHE_TTL, get_provider_cache, save_provider_cache
 
+PROVIDER_CACHE_TTL = 300        # in-process, seconds
+PROVIDER_CACHE_MAXSIZE = 4096
+
+# Cap concurrent outbound calls per provider to stay under rate limits
+_VT_SEM = asyncio.Semaphore(10)
+_ST_SEM = asyncio.Semaphore(5)
+_HUNTER_SEM = asyncio.Semaphore(5)
+
+# Shared client so keep-alive connections are reused across lookups
+_client: Optional[httpx.AsyncClient] = None
+
+def get_client() -> httpx.AsyncClient:
+    """Return the shared AsyncClient, creating it on first use"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+            timeout=httpx.Timeout(10.0, connect=3.0),
+        )
+    return _client
+
+async def close_client():
+    """Close the shared AsyncClient (called on app shutdown)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# (provider, ioc) -> (expires_at, data)
+_results: dict[tuple[str, str], tuple[float, dict]] = {}
+
+def _cached_provider(name: str):
+    """
+    Reuse recent provider results instead of calling the API again
+
+    Checks the in-process cache, then the provider_cache table, and only
+    then runs the lookup. Failed lookups (None) are not cached.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(ioc: str) -> Optional[dict]:
+            key = (name, ioc)
+            entry = _results.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+
+            data = await get_provider_cache(ioc, name, PROVIDER_DB_CACHE_TTL)
+            if data is None:
+                data = await func(ioc)
+                if data is None:
+                    return None
+                await save_provider_cache(ioc, name, data)
+
+            _results.pop(key, None)
+            _results[key] = (time.monotonic() + PROVIDER_CACHE_TTL, data)
+            if len(_results) > PROVIDER_CACHE_MAXSIZE:
+                _results.pop(next(iter(_results)))
+            return data
+        return wrapper
+    return decorator
+
+@_cached_provider("vt")
 async def vt_lookup(ioc: str) -> dict:
     """Lookup IOC in VirusTotal"""
     if not settings.VT_API_KEY:
         return None
     
     try:
-        async with httpx.AsyncClient() as client:
-            headers = {"x-apikey": settings.VT_API_KEY}
-            url = f"https://www.virustotal.com/api/v3/domains/{ioc}"
-            resp = await client.get(url, headers=headers, timeout=10)
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                last_analysis = data.get("data", {}).get("attributes", {}).get("last_analysis_stats", {})
-                return {
-                    "detections": last_analysis.get("malicious", 0),
-                    "total": 0,
-                    "url": f"https://www.virustotal.com/gui/domain/{ioc}"
-                }
+        headers = {"x-apikey": settings.VT_API_KEY}
+        url = f"https://www.virustotal.com/api/v3/domains/{ioc}"
+        async with _VT_SEM:
+            resp = await get_client().get(url, headers=headers)
+        
+        if resp.status_code == 200:
+            data = orjson.loads(resp.content)
+            last_analysis = data.get("data", {}).get("attributes", {}).get("last_analysis_stats", {})
+            return {
+                "detections": last_analysis.get("malicious", 0),
+                "total": 0,
+                "url": f"https://www.virustotal.com/gui/domain/{ioc}"
+            }
     except Exception as e:
         print(f"VT error: {e}")
     return None
 
+@_cached_provider("st")
 async def securitytrails_lookup_domain(domain: str) -> dict:
     """Lookup domain in SecurityTrails"""
     if not settings.SECURITYTRAILS_API_KEY:
         return None
     
     try:
-        async with httpx.AsyncClient() as client:
-            headers = {"apikey": settings.SECURITYTRAILS_API_KEY}
-            url = f"https://api.securitytrails.com/v1/domain/{domain}/dns"
-            resp = await client.get(url, headers=headers, timeout=10)
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                return {"resolutions": data.get("records", [])}
+        headers = {"apikey": settings.SECURITYTRAILS_API_KEY}
+        url = f"https://api.securitytrails.com/v1/domain/{domain}/dns"
+        async with _ST_SEM:
+            resp = await get_client().get(url, headers=headers)
+        
+        if resp.status_code == 200:
+            data = orjson.loads(resp.content)
+            return {"resolutions": data.get("records", [])}
     except Exception as e:
         print(f"SecurityTrails error: {e}")
     return None
 
+@_cached_provider("whois")
 async def hunter_lookup_domain(domain: str) -> dict:
     """Lookup domain in Hunter.io (email/OSINT)"""
     if not settings.HUNTER_API_KEY:
         return None
     
     try:
-        async with httpx.AsyncClient() as client:
-            url = "https://api.hunter.io/v2/domain-search"
-            params = {"domain": domain, "api_key": settings.HUNTER_API_KEY}
-            resp = await client.get(url, params=params, timeout=10)
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                return {"emails": len(data.get("emails", []))}
+        url = "https://api.hunter.io/v2/domain-search"
+        params = {"domain": domain, "api_key": settings.HUNTER_API_KEY}
+        async with _HUNTER_SEM:
+            resp = await get_client().get(url, params=params)
+        
+        if resp.status_code == 200:
+            data = orjson.loads(resp.content)
+            return {"emails": len(data.get("emails", []))}
     except Exception as e:
         print(f"Hunter error: {e}")
     return None
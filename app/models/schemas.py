@@ -26,6 +26,7 @@ class IOCSummary(BaseModel):
     created_at: str
 
 class IOCHistoryEntry(BaseModel):
+    id: int
     ioc: str
     ioc_type: str
     score: int
@@ -34,6 +35,7 @@ class IOCHistoryEntry(BaseModel):
     created_at: str
 
 class IOCTimeline(BaseModel):
+    id: int
     timestamp: str
     score: int
     risk_level: str
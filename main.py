@@ -1,9 +1,32 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.ioc import router as ioc_router
 from app.core.config import settings
+from app.core.providers import get_client, close_client
+from app.core.cache import init_cache, close_cache
+from app.core.db import DatabaseBusyError, init_db, close_db, start_writer, stop_writer
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_db()
+    get_client()
+    await init_cache()
+    start_writer()
+    yield
+    await stop_writer()
+    await close_client()
+    await close_cache()
+    close_db()
 
-app = FastAPI(title="Nauthiz", version="0.1")
+app = FastAPI(
+    title="Nauthiz",
+    version="0.1",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -13,6 +36,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(DatabaseBusyError)
+async def database_busy_handler(request, exc):
+    return ORJSONResponse(status_code=503, content={"detail": "Database busy, try again"})
+
 app.include_router(ioc_router, prefix="/api", tags=["IOC"])
 
 @app.get("/")
@@ -21,4 +48,11 @@ def root():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=settings.PORT, reload=True)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=settings.PORT,
+        reload=True,
+        loop="uvloop",
+        http="httptools",
+    )
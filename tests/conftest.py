@@ -0,0 +1,18 @@
+import os
+
+import pytest
+
+# Settings() requires API_KEY at import time
+os.environ.setdefault("API_KEY", "test-key")
+
+from app.core import db as db_module
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh database in tmp_path, closed again after the test"""
+    monkeypatch.setattr(db_module, "DB_PATH", tmp_path / "test.db")
+    monkeypatch.setattr(db_module, "POOL_CLOSE_TIMEOUT", 0.1)
+    db_module.init_db()
+    yield db_module
+    db_module.close_db()
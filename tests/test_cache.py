@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from app.core import cache
+
+
+@pytest.fixture(autouse=True)
+def local_cache(monkeypatch):
+    monkeypatch.setattr(cache, "_redis", None)
+    cache._local.clear()
+    cache._versions.clear()
+    yield
+    cache._local.clear()
+    cache._versions.clear()
+
+
+def _summary_endpoint(db, reading=None, release=None):
+    """A cached endpoint reading db["score"], optionally pausing after the read"""
+    @cache.cached(ttl=60, key=lambda ioc: f"sum:{ioc}")
+    async def get_summary(ioc):
+        row = {"ioc": ioc, "score": db["score"]}
+        if reading is not None:
+            reading.set()
+            await release.wait()
+        return row
+    return get_summary
+
+
+def test_reader_racing_a_write_never_serves_stale_value():
+    async def scenario():
+        db = {"score": 10}
+        reading, release = asyncio.Event(), asyncio.Event()
+        slow_read = asyncio.create_task(_summary_endpoint(db, reading, release)("a.com"))
+
+        # Writer commits and invalidates while the reader holds the old row
+        await reading.wait()
+        db["score"] = 90
+        await cache.cache_invalidate("sum:a.com")
+        release.set()
+        assert (await slow_read)["score"] == 10
+
+        # The stale result was cached under the old version and is never read
+        get_summary = _summary_endpoint(db)
+        assert (await get_summary("a.com"))["score"] == 90
+        db["score"] = 50
+        assert (await get_summary("a.com"))["score"] == 90
+
+    asyncio.run(scenario())
+
+
+def test_stale_set_after_invalidate_is_ignored():
+    async def scenario():
+        version = await cache.cache_version("sum:a.com")
+        await cache.cache_invalidate("sum:a.com")
+        await cache.cache_set(f"sum:a.com@{version}", '{"score": 10}', 60)
+
+        db = {"score": 90}
+        assert (await _summary_endpoint(db)("a.com"))["score"] == 90
+
+    asyncio.run(scenario())
+
+
+def test_evicted_version_does_not_resurrect_stale_value(monkeypatch):
+    monkeypatch.setattr(cache, "_LOCAL_MAXSIZE", 2)
+
+    async def scenario():
+        # A reader that saw version 0 stores its result after the write
+        version = await cache.cache_version("sum:a.com")
+        assert version == "0"
+        await cache.cache_invalidate("sum:a.com")
+        await cache.cache_set("sum:a.com@0", '{"score": 10}', 60)
+
+        # Enough other writes to push sum:a.com out of _versions
+        await cache.cache_invalidate("sum:b.com", "sum:c.com")
+        assert "sum:a.com" not in cache._versions
+        assert await cache.cache_version("sum:a.com") == "0"
+
+        db = {"score": 90}
+        assert (await _summary_endpoint(db)("a.com"))["score"] == 90
+
+    asyncio.run(scenario())
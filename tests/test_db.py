@@ -0,0 +1,123 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+
+def test_pool_refuses_checkouts_after_shutdown(db):
+    db.close_db()
+    with pytest.raises(db.DatabaseBusyError):
+        with db.get_conn():
+            pass
+    assert db._pool is None
+
+
+def test_close_db_does_not_close_connections_in_use(db):
+    checked_out = threading.Event()
+    release = threading.Event()
+    result = {}
+
+    def long_query():
+        with db.get_conn() as conn:
+            result["conn"] = conn
+            checked_out.set()
+            release.wait()
+            result["row"] = conn.execute("SELECT 1").fetchone()
+
+    worker = threading.Thread(target=long_query)
+    worker.start()
+    checked_out.wait()
+    db.close_db()
+    release.set()
+    worker.join()
+
+    # The query finished on its connection, which was closed once returned
+    assert result["row"] == (1,)
+    with pytest.raises(sqlite3.ProgrammingError):
+        result["conn"].execute("SELECT 1")
+
+
+def _row(db, ioc, score=10):
+    return db._query_row(ioc, "domain", score, "low", [], None, None, None)
+
+
+def _count(db):
+    with db.get_conn() as conn:
+        return conn.execute("SELECT COUNT(*) FROM ioc_queries").fetchone()[0]
+
+
+def test_bad_row_does_not_drop_the_batch(db):
+    rows = [_row(db, "a.com"), _row(db, "b.com", score=101), _row(db, "c.com")]
+    failed = db._sync_save_queries(rows)
+
+    assert [row[0] for row, _ in failed] == ["b.com"]
+    assert isinstance(failed[0][1], sqlite3.IntegrityError)
+    assert _count(db) == 2
+
+
+def test_locked_database_retries_the_whole_batch(db, monkeypatch):
+    monkeypatch.setattr(db, "WRITE_RETRY_BACKOFF", 0)
+    insert = db._insert_queries
+    calls = []
+
+    def flaky_insert(rows):
+        calls.append(len(rows))
+        if len(calls) < 3:
+            raise sqlite3.OperationalError("database is locked")
+        insert(rows)
+
+    monkeypatch.setattr(db, "_insert_queries", flaky_insert)
+    assert db._sync_save_queries([_row(db, "a.com"), _row(db, "b.com")]) == []
+    assert calls == [2, 2, 2]
+    assert _count(db) == 2
+
+
+def test_locked_database_gives_up_after_retries(db, monkeypatch):
+    monkeypatch.setattr(db, "WRITE_RETRY_BACKOFF", 0)
+    calls = []
+
+    def locked_insert(rows):
+        calls.append(len(rows))
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(db, "_insert_queries", locked_insert)
+    failed = db._sync_save_queries([_row(db, "a.com"), _row(db, "b.com")])
+
+    assert len(failed) == 2
+    assert calls == [2] * (db.WRITE_RETRIES + 1)
+
+
+def test_full_write_queue_fails_fast(db, monkeypatch):
+    monkeypatch.setattr(db, "WRITE_QUEUE_SIZE", 1)
+    monkeypatch.setattr(db, "_writer_loop", lambda: asyncio.Event().wait())
+
+    async def scenario():
+        db.start_writer()
+        try:
+            await db.save_query("a.com", "domain", 10, "low", [], None, None, None)
+            with pytest.raises(db.DatabaseBusyError):
+                await db.save_query("b.com", "domain", 10, "low", [], None, None, None)
+        finally:
+            db._writer_task.cancel()
+            db._insert_queue = db._writer_task = None
+
+    asyncio.run(scenario())
+
+
+def test_stop_writer_gives_up_on_a_stuck_write(db, monkeypatch):
+    monkeypatch.setattr(db, "WRITER_STOP_TIMEOUT", 0.1)
+    monkeypatch.setattr(db, "WRITE_BATCH_WAIT", 0)
+
+    async def stuck_flush(rows):
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(db, "_flush", stuck_flush)
+
+    async def scenario():
+        db.start_writer()
+        await db.save_query("a.com", "domain", 10, "low", [], None, None, None)
+        await asyncio.wait_for(db.stop_writer(), 1)
+        assert db._writer_task is None
+
+    asyncio.run(scenario())
@@ -0,0 +1,54 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.core.config import settings
+from main import app
+
+SAME_TIME = "2024-12-10T16:47:23.456+00:00"
+
+
+@pytest.fixture
+def client(db):
+    """API client over a database holding five a.com entries with the same created_at, and one b.com entry"""
+    rows = [db._query_row("a.com", "domain", score, "low", [], None, None, None, SAME_TIME) for score in range(5)]
+    rows.append(db._query_row("b.com", "domain", 50, "medium", [], None, None, None, SAME_TIME))
+    assert db._sync_save_queries(rows) == []
+    return TestClient(app, headers={"X-API-Key": settings.API_KEY})
+
+
+def _pages(client, endpoint, cursor):
+    """Follow the cursor through every page, returning the ids of each page"""
+    pages, params = [], {"limit": 2}
+    while True:
+        response = client.get(f"/api/api/{endpoint}/a.com", params=params)
+        assert response.status_code == 200
+        ids = [entry["id"] for entry in response.json()]
+        pages.append(ids)
+        if not ids:
+            return pages
+        params[cursor] = ids[-1]
+
+
+def test_timeline_pages_through_equal_timestamps(client):
+    assert _pages(client, "timeline", "after_id") == [[1, 2], [3, 4], [5], []]
+
+
+def test_history_pages_through_equal_timestamps(client):
+    assert _pages(client, "history", "before_id") == [[5, 4], [3, 2], [1], []]
+
+
+@pytest.mark.parametrize("endpoint, cursor", [("history", "before_id"), ("timeline", "after_id")])
+@pytest.mark.parametrize("entry_id", [6, 999], ids=["foreign", "missing"])
+def test_unknown_cursor_is_rejected(client, endpoint, cursor, entry_id):
+    response = client.get(f"/api/api/{endpoint}/a.com", params={cursor: entry_id})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("endpoint, cursor, last_id", [("history", "before_id", 1), ("timeline", "after_id", 5)])
+def test_empty_page_vs_unknown_ioc(client, endpoint, cursor, last_id):
+    response = client.get(f"/api/api/{endpoint}/a.com", params={cursor: last_id})
+    assert response.status_code == 200
+    assert response.json() == []
+    assert response.headers["content-length"] == "2"
+
+    assert client.get(f"/api/api/{endpoint}/c.com").status_code == 404